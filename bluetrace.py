@@ -1,16 +1,17 @@
 # bluetrace.py: A module for the BlueTrace protocol
 # by James Davidson for COMP3331, 20T2
 
-from threading import Thread, Lock
+from threading import Thread, Lock, BoundedSemaphore
 from time import time, sleep
 from datetime import datetime, timedelta
 from os import path
 from random import choice
 from string import digits
-from socket import socket, AF_INET, SOCK_STREAM, SOL_SOCKET, \
+from socket import socket, timeout, AF_INET, SOCK_STREAM, SOL_SOCKET, \
                    SO_REUSEADDR, SOCK_DGRAM
 
 import bluetrace_protocol
+from bluetrace_storage import BlueTraceFileStorage
 
 ''' Common helper functions '''
 
@@ -49,11 +50,54 @@ def convert_epoch_to_timestamp(epoch):
     return datetime.fromtimestamp(epoch)
 
 
+def format_contact_log_entry(temp_id, start, end, first_seen, last_seen,
+                             count):
+    '''
+    Returns a line of a contact log for an encounter with a temp ID, valid
+    from start to end, which beaconed count times between the first_seen and
+    last_seen timestamps.
+
+    This is the inverse function of parse_contact_log_entry().
+    '''
+
+    count = str(count).zfill(bluetrace_protocol.ENCOUNTER_COUNT_SIZE)
+    return f'{temp_id} {start} {end} {first_seen} {last_seen} {count}'
+
+
+def parse_contact_log_entry(line):
+    '''
+    Splits a line of a contact log into its temp ID, the timestamps at which
+    the temp ID starts and expires, the timestamps at which it was first and
+    last received, and the number of times it was received.
+
+    A ValueError is raised if the line isn't a valid entry (e.g. because it
+    was written by an older version of the client).
+
+    This is the inverse function of format_contact_log_entry().
+    '''
+
+    temp_id, *timestamps, count = line.split()
+    if len(timestamps) != 8 or not count.isdigit():
+        raise ValueError(f'Invalid contact log entry: {line}')
+
+    entry = (temp_id, *(' '.join(timestamps[i:i + 2])
+                        for i in range(0, len(timestamps), 2)), count)
+    for timestamp in entry[1:5]:
+        convert_timestamp_to_epoch(timestamp)
+
+    return entry
+
+
 ''' Server classes '''
 
 
 class BlueTraceServerThread(Thread):
-    ''' A thread running on a BlueTrace server. '''
+    '''
+    A thread running on a BlueTrace server.
+
+    Each thread serves one client session, which ends when the client logs
+    out, disconnects or stalls for longer than the server's timeouts allow.
+    '''
 
     def __init__(self, server, client_socket):
         super().__init__()
@@ -65,6 +109,19 @@ class BlueTraceServerThread(Thread):
 
     ''' Helper server thread methods '''
 
+    def _receive(self, size=1024):
+        '''
+        Receives a message of up to size bytes from the client.
+
+        A ConnectionError is raised if the client has disconnected.
+        '''
+
+        message = self._socket.recv(size)
+        if not message:
+            raise ConnectionResetError('Client disconnected')
+
+        return message
+
     def _verify_password(self, username, password):
         '''
         Verifies the client's entered password, prompting them to re-enter it
@@ -78,7 +135,7 @@ class BlueTraceServerThread(Thread):
         attempts = 1
         while password != expected_password and attempts < 3:
             self._socket.send(bluetrace_protocol.INVALID_CREDENTIALS)
-            password = self._socket.recv(1024).decode()
+            password = self._receive().decode()
             attempts += 1
 
         return attempts
@@ -94,16 +151,18 @@ class BlueTraceServerThread(Thread):
 
         # Initiate authentication with the connecting client
         self._socket.send(bluetrace_protocol.INITIATING_AUTH)
-        response = self._socket.recv(1024)
+        response = self._receive()
         while response != bluetrace_protocol.READY_TO_AUTH:
             self._socket.send(bluetrace_protocol.INITIATING_AUTH)
-            response = self._socket.recv(1024)
+            response = self._receive()
 
-        # After the client has acknowledged, ask for a username and password
+        # After the client has acknowledged, ask for a username and password,
+        # giving the user as long to type them as they have to issue requests
+        self._socket.settimeout(self._server.get_idle_timeout())
         self._socket.send(bluetrace_protocol.EXPECTING_USERNAME)
-        username = self._socket.recv(1024).decode()
+        username = self._receive().decode()
         self._socket.send(bluetrace_protocol.EXPECTING_PASSWORD)
-        password = self._socket.recv(1024).decode()
+        password = self._receive().decode()
 
         # If the client is blocked, tell them and end authentication
         if self._server.is_blocked(username):
@@ -125,25 +184,31 @@ class BlueTraceServerThread(Thread):
     def _receive_contact_log(self):
         ''' Receives a contact log from the user. '''
 
-        # Inform the client that we're ready to receive the contact log
-        self._socket.send(bluetrace_protocol.READY_FOR_LOG_UPLOAD)
+        # Inform the client that we're ready to receive the contact log, and
+        # that it only needs to send what it received after the watermark
+        watermark = self._server.get_upload_watermark(self._username)
+        self._socket.send(bluetrace_protocol.READY_FOR_LOG_UPLOAD
+                          + (f' {watermark}' if watermark else '').encode())
 
         print(f'Received contact log from {self._username}')
 
         # Read the log's lines into a list while there's lines left
         contact_log = []
-        response = self._socket.recv(bluetrace_protocol.LOG_ENTRY_SIZE)
+        response = self._receive(bluetrace_protocol.LOG_ENTRY_SIZE)
         while response != bluetrace_protocol.FINISHED_CONTACT_LOG:
             line = response.decode()
+            response = self._receive(bluetrace_protocol.LOG_ENTRY_SIZE)
+            try:
+                temp_id, start, end, *_ = parse_contact_log_entry(line)
+            except ValueError:
+                print(f'Skipping invalid contact log entry: {line}')
+                continue
+
             contact_log.append(line)
-            temp_id, start_date, start_time, end_date, end_time = line.split()
-            start = f'{start_date} {start_time}'
-            end = f'{end_date} {end_time}'
             print(f'{temp_id}, {start}, {end}')
-            response = self._socket.recv(bluetrace_protocol.LOG_ENTRY_SIZE)
 
         # Pass the log to the server to check.
-        self._server.check_contact_log(contact_log)
+        self._server.check_contact_log(self._username, contact_log)
 
     def _handle_request(self, request):
         ''' Handles a request issued by the client. '''
@@ -162,148 +227,181 @@ class BlueTraceServerThread(Thread):
         This method overrides the threading.Thread superclass method.
         '''
 
-        # Authenticate the incoming connection first
-        if not self._authenticate():
-            return
+        try:
+            # Authenticate the incoming connection first, only waiting on the
+            # client's acknowledgement for as long as any other exchange
+            self._socket.settimeout(self._server.get_io_timeout())
+            if not self._authenticate():
+                return
+
+            # Receive requests from the client until they try to log out,
+            # giving them longer to issue each request than to finish it
+            request = self._receive()
+            while request != bluetrace_protocol.LOGOUT_CLIENT:
+                self._socket.settimeout(self._server.get_io_timeout())
+                self._handle_request(request)
+                self._socket.settimeout(self._server.get_idle_timeout())
+                request = self._receive()
+
+            print(f'User {self._username} has logged out.')
+        except timeout:
+            print(f'Session with {self._username or "client"} timed out.')
+        except OSError:
+            print(f'Session with {self._username or "client"} was lost.')
+        finally:
+            self._socket.close()
+            self._server.end_session()
 
-        # Receive requests from the client until they try to log out
-        request = self._socket.recv(1024)
-        while request != bluetrace_protocol.LOGOUT_CLIENT:
-            self._handle_request(request)
-            request = self._socket.recv(1024)
 
-        print(f'User {self._username} has logged out.')
+class BlueTraceServer():
+    '''
+    A server in the BlueTrace protocol.
 
+    Credentials, temp IDs, blocked users and uploaded contact logs are kept in
+    a storage backend, which defaults to flat text files.
 
-class BlueTraceServer():
-    ''' A server in the BlueTrace protocol. '''
+    At most max_sessions clients are served at once, and any others that
+    connect are told that the server is busy. Sessions are ended if the client
+    doesn't issue a request within idle_timeout seconds, or stalls for more
+    than io_timeout seconds partway through an exchange.
+    '''
 
-    def __init__(self, port, block_duration):
+    def __init__(self, port, block_duration, storage=None,
+                 max_sessions=bluetrace_protocol.MAX_SESSIONS,
+                 idle_timeout=bluetrace_protocol.SESSION_IDLE_TIMEOUT,
+                 io_timeout=bluetrace_protocol.SESSION_IO_TIMEOUT):
         self._port = port
         self._block_duration = block_duration
         self._server_socket = None
-        self._blocked_users = {}
-        self._resource_locks = {
-            'blocked_users': Lock(),
-            'credentials': Lock(),
-            'temp_ids': Lock()
-        }
+        self._storage = storage or BlueTraceFileStorage()
+        self._sessions = BoundedSemaphore(max_sessions)
+        self._idle_timeout = idle_timeout
+        self._io_timeout = io_timeout
 
-    ''' Helper server methods '''
+    ''' Getter methods '''
 
-    def get_password(self, client_username):
-        ''' Retrieves a user's password from the credentials file. '''
+    def get_idle_timeout(self):
+        ''' Gets the time to wait for a client's next request, in seconds. '''
+
+        return self._idle_timeout
 
-        client_password = None
+    def get_io_timeout(self):
+        '''
+        Gets the time to wait on a client partway through an exchange,
+        in seconds.
+        '''
 
-        with self._resource_locks['credentials']:
-            with open('credentials.txt', 'r+') as credentials:
-                line = credentials.readline().strip()
-                while line and client_password is None:
-                    username, password = line.split()
-                    if username == client_username:
-                        client_password = password
-                    else:
-                        line = credentials.readline().strip()
+        return self._io_timeout
 
-        return client_password
+    ''' Helper server methods '''
+
+    def get_password(self, client_username):
+        ''' Retrieves a user's password from the server's storage. '''
+
+        return self._storage.get_password(client_username)
 
     def _get_username_from_temp_id(self, client_temp_id):
         ''' Gets the username associated with the given temp ID. '''
 
-        client_username = None
+        # Return ??? if the user's temp ID is not known
+        return self._storage.get_username_from_temp_id(client_temp_id) or '???'
 
-        with self._resource_locks['temp_ids']:
-            with open('tempIDs.txt', 'r+') as temp_ids:
-                line = temp_ids.readline()
-                while line and client_username is None:
-                    username, temp_id, *_ = line.split()
-                    if temp_id == client_temp_id:
-                        client_username = username
-                    else:
-                        line = temp_ids.readline()
+    def get_upload_watermark(self, client_username):
+        '''
+        Gets the timestamp at which the most recent entry the server has
+        stored from a user's contact log was last received, or None if there
+        is none.
+        '''
 
-        # Return ??? if the user's temp ID is not known
-        return client_username or '???'
+        return self._storage.get_upload_watermark(client_username)
+
+    def _reject(self, client_socket):
+        ''' Tells a client that the server is busy and disconnects them. '''
+
+        with client_socket:
+            client_socket.settimeout(self._io_timeout)
+            try:
+                client_socket.send(bluetrace_protocol.SERVER_BUSY)
+            except OSError:
+                pass
 
     ''' Main server methods and entry point '''
 
-    def is_blocked(self, username):
-        ''' Determines if a user is blocked or not. '''
+    def end_session(self):
+        ''' Frees up the session slot held by a finished server thread. '''
 
-        blocked = True
+        self._sessions.release()
 
-        with self._resource_locks['blocked_users']:
-            block_time = self._blocked_users.get(username, None)
-            if block_time is None or block_time <= int(time()):
-                self._blocked_users.pop(username, None)
-                blocked = False
+    def is_blocked(self, username):
+        ''' Determines if a user is blocked or not. '''
 
-        return blocked
+        return self._storage.is_blocked(username, int(time()))
 
     def block(self, username):
         ''' Blocks a user for block_duration seconds. '''
 
-        with self._resource_locks['blocked_users']:
-            self._blocked_users[username] = int(time()) \
-                                          + self._block_duration
+        self._storage.block(username, int(time()) + self._block_duration)
 
     def generate_temp_id(self, username):
         '''
         Returns a new temp ID for a user, valid for 15 minutes.
 
-        An appropriate entry in the temp IDs file is written, and if this file
-        does not already exist beforehand, it will be created.
+        The temp ID is recorded in the server's storage.
         '''
 
         temp_id = ''.join(choice(digits) \
                           for _ in range(bluetrace_protocol.TEMP_ID_SIZE))
 
-        with self._resource_locks['temp_ids']:
-            with open('tempIDs.txt', 'a+') as temp_ids:
-                start = generate_timestamp(datetime.now())
-                end = generate_timestamp(datetime.now(),
-                                         offset=bluetrace_protocol.TEMP_ID_TTL)
-                temp_ids.write(f'{username} {temp_id} {start} {end}\n')
+        start = generate_timestamp(datetime.now())
+        end = generate_timestamp(datetime.now(),
+                                 offset=bluetrace_protocol.TEMP_ID_TTL)
+        self._storage.add_temp_id(username, temp_id, start, end)
 
         print(f'Temp ID {temp_id} generated for {username}.')
         return temp_id
 
-    def check_contact_log(self, contact_log):
+    def check_contact_log(self, username, contact_log):
         '''
-        Checks the contents of a received contact log, mapping the temp IDs
-        of the encounters back to their true usernames.
+        Stores and checks the contents of a contact log received from a user,
+        mapping the temp IDs of the encounters back to their true usernames.
 
-        The processed contents are displayed on the server's end.
+        Entries which have already been stored by a previous upload are
+        skipped (unless they have received more beacons since), and the
+        processed contents are displayed on the server's end.
         '''
 
         print('Checking contact log')
 
-        for line in contact_log:
-            temp_id, start_date, start_time, *_ = line.split()
-            username = self._get_username_from_temp_id(temp_id)
-            encounter_time = ' '.join((start_date, start_time))
-            print(f'{username}, {encounter_time}, {temp_id}')
+        entries = map(parse_contact_log_entry, contact_log)
+        new_entries = self._storage.add_contact_log(username, entries)
+
+        for temp_id, encounter_time, *_ in new_entries:
+            contact_username = self._get_username_from_temp_id(temp_id)
+            print(f'{contact_username}, {encounter_time}, {temp_id}')
 
     def start(self):
         ''' Starts this BlueTrace server. '''
 
-        # Create a file to store temporary IDs if there isn't one already
-        with self._resource_locks['temp_ids']:
-            if not path.exists('tempIDs.txt'):
-                open('tempIDs.txt', 'w').close()
-
         # Start a new welcoming socket for incoming connections
         with socket(AF_INET, SOCK_STREAM) as server_socket:
             self._server_socket = server_socket
             server_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
             server_socket.bind(('localhost', self._port))
-            server_socket.listen(1)
+            server_socket.listen(bluetrace_protocol.ACCEPT_BACKLOG)
 
-            while True:
-                client_socket, _ = server_socket.accept()
-                client_thread = BlueTraceServerThread(self, client_socket)
-                client_thread.start()
+            try:
+                while True:
+                    client_socket, _ = server_socket.accept()
+
+                    # Turn the client away if there are no free session slots
+                    if not self._sessions.acquire(blocking=False):
+                        self._reject(client_socket)
+                        continue
+
+                    client_thread = BlueTraceServerThread(self, client_socket)
+                    client_thread.start()
+            finally:
+                self._storage.close()
 
 
 ''' Client classes '''
@@ -317,6 +415,7 @@ class BlueTraceClientCentralSubthread(Thread):
         self.daemon = True
         self._client = client
         self._beacon = ', '.join(beacon.decode().split(', ')[:-1])
+        self._received = generate_timestamp(datetime.now())
         print()
         self._contact_log = f'{self._client.get_username()}-contactlog.txt'
 
@@ -340,14 +439,77 @@ class BlueTraceClientCentralSubthread(Thread):
     def _write_beacon(self):
         ''' Writes a beacon to the central client's contact log. '''
 
+        temp_id, start_time, end_time = self._beacon.split(', ')
+        entry = format_contact_log_entry(temp_id, start_time, end_time,
+                                         self._received, self._received, 1)
+
         with self._client.get_contact_log_lock():
             with open(self._contact_log, 'a+') as contact_log:
-                contact_log.write(self._beacon + '\n')
+                contact_log.write(entry + '\n')
+
+    def _aggregate_beacon(self):
+        '''
+        Merges a beacon into the client's open encounter with its temp ID.
+
+        If there is no such encounter, this subthread opens one and waits until
+        no beacon has been received for it within the client's encounter gap,
+        before writing it to the contact log. Whether or not this subthread
+        opened an encounter is returned.
+        '''
+
+        temp_id, start_time, end_time = self._beacon.split(', ')
+        gap = self._client.get_encounter_gap()
+
+        with self._client.get_open_encounters_lock():
+            open_encounters = self._client.get_open_encounters()
+            encounter = open_encounters.get(temp_id, None)
+            if encounter is not None:
+                idle = convert_timestamp_to_epoch(self._received) \
+                     - convert_timestamp_to_epoch(encounter['last_seen'])
+                if idle <= gap and encounter['count'] < \
+                        10 ** bluetrace_protocol.ENCOUNTER_COUNT_SIZE - 1:
+                    # Subthreads can get here out of order, so an earlier
+                    # beacon mustn't move the encounter's last seen time back
+                    if idle > 0:
+                        encounter['last_seen'] = self._received
+                    encounter['count'] += 1
+                    return False
+
+                # The encounter has already ended, so write it out before
+                # opening a new one (its subthread will schedule its removal)
+                self._client.flush_encounter(encounter)
+
+            encounter = {
+                'temp_id': temp_id,
+                'start': start_time,
+                'end': end_time,
+                'first_seen': self._received,
+                'last_seen': self._received,
+                'count': 1,
+                'flushed': False
+            }
+            open_encounters[temp_id] = encounter
+
+        # Wait for the encounter to end, unless it is written out beforehand
+        # (e.g. because the client is logging out)
+        while True:
+            with self._client.get_open_encounters_lock():
+                if encounter['flushed']:
+                    break
+
+                idle = time() - convert_timestamp_to_epoch(encounter['last_seen'])
+                if idle > gap:
+                    self._client.flush_encounter(encounter)
+                    break
+
+            sleep(gap - idle + 1)
+
+        return True
 
     def _schedule_beacon_removal(self):
         '''
-        Ensures that this subthread's associated beacon is removed from the
-        client's contact log when it has expired.
+        Ensures that this subthread's associated beacon (or encounter) is
+        removed from the client's contact log when it has expired.
         '''
 
         sleep(bluetrace_protocol.BEACON_TTL)
@@ -370,9 +532,14 @@ class BlueTraceClientCentralSubthread(Thread):
         temp_id, start_time, end_time = self._beacon.split(', ')
         print(f'Received beacon:\n{temp_id}, {start_time}, {end_time}')
 
-        if self._validate_beacon():
+        if not self._validate_beacon():
+            return
+
+        if self._client.get_encounter_gap() is None:
             self._write_beacon()
             self._schedule_beacon_removal()
+        elif self._aggregate_beacon():
+            self._schedule_beacon_removal()
 
 
 class BlueTraceClientCentralThread(Thread):
@@ -447,17 +614,26 @@ class BlueTraceClientPeripheralThread(Thread):
 
 
 class BlueTraceClient():
-    ''' A client in the BlueTrace protocol. '''
+    '''
+    A client in the BlueTrace protocol.
+
+    If an encounter gap (in seconds) is given, consecutive beacons received
+    from the same temp ID no more than that far apart are aggregated into one
+    contact log entry. Otherwise, every beacon gets its own entry.
+    '''
 
-    def __init__(self, server_ip, server_port, client_port):
+    def __init__(self, server_ip, server_port, client_port, encounter_gap=None):
         self._server_ip = server_ip
         self._server_port = server_port
         self._client_port = client_port
+        self._encounter_gap = encounter_gap
         self._client_socket = None
         self._central_socket = None
         self._username = None
         self._temp_id = None
+        self._open_encounters = {}
         self._contact_log_lock = Lock()
+        self._open_encounters_lock = Lock()
 
     ''' Getter methods '''
 
@@ -466,13 +642,81 @@ class BlueTraceClient():
 
         return self._contact_log_lock
 
+    def get_encounter_gap(self):
+        ''' Gets the client's encounter gap, or None if not aggregating. '''
+
+        return self._encounter_gap
+
+    def get_open_encounters(self):
+        '''
+        Gets the client's encounters which have not yet been written to the
+        contact log, keyed by temp ID.
+        '''
+
+        return self._open_encounters
+
+    def get_open_encounters_lock(self):
+        ''' Get the client's open encounters mutex. '''
+
+        return self._open_encounters_lock
+
     def get_username(self):
         ''' Gets the client's username. '''
 
         return self._username
 
+    ''' Encounter aggregation methods '''
+
+    @staticmethod
+    def _format_encounter(encounter):
+        ''' Returns the contact log entry for an encounter. '''
+
+        return format_contact_log_entry(encounter['temp_id'],
+                                        encounter['start'],
+                                        encounter['end'],
+                                        encounter['first_seen'],
+                                        encounter['last_seen'],
+                                        encounter['count'])
+
+    def flush_encounter(self, encounter):
+        '''
+        Writes an open encounter to the client's contact log and closes it.
+
+        The caller must hold the client's open encounters mutex.
+        '''
+
+        if self._open_encounters.get(encounter['temp_id'], None) is encounter:
+            del self._open_encounters[encounter['temp_id']]
+
+        encounter['flushed'] = True
+        entry = self._format_encounter(encounter)
+
+        with self._contact_log_lock:
+            with open(f'{self._username}-contactlog.txt', 'a+') as contact_log:
+                contact_log.write(entry + '\n')
+
+    def _flush_open_encounters(self):
+        ''' Writes all of the client's open encounters to its contact log. '''
+
+        with self._open_encounters_lock:
+            for encounter in list(self._open_encounters.values()):
+                self.flush_encounter(encounter)
+
     ''' Helper client methods '''
 
+    def _receive(self, size=1024):
+        '''
+        Receives a message of up to size bytes from the server.
+
+        A ConnectionError is raised if the server has disconnected.
+        '''
+
+        message = self._client_socket.recv(size)
+        if not message:
+            raise ConnectionResetError('Server disconnected')
+
+        return message
+
     def _verify_password(self):
         '''
         Verifies a user's entered password with the server until the server
@@ -483,14 +727,14 @@ class BlueTraceClient():
 
         password = input('> Password: ')
         self._client_socket.send(password.encode())
-        response = self._client_socket.recv(1024)
+        response = self._receive()
 
         # Keep prompting the user to enter their password as required
         while response == bluetrace_protocol.INVALID_CREDENTIALS:
             print(response.decode())
             password = input('> Password: ')
             self._client_socket.send(password.encode())
-            response = self._client_socket.recv(1024)
+            response = self._receive()
 
         return response
 
@@ -507,17 +751,17 @@ class BlueTraceClient():
 
         # The server will first ask for the username, so prompt the user to
         # enter their username and then send it
-        response = self._client_socket.recv(1024)
+        response = self._receive()
         while response != bluetrace_protocol.EXPECTING_USERNAME:
-            response = self._client_socket.recv(1024)
+            response = self._receive()
 
         username = input('> Username: ')
         self._client_socket.send(username.encode())
 
         # The server will next ask for a password, so prompt the user again
-        response = self._client_socket.recv(1024)
+        response = self._receive()
         while response != bluetrace_protocol.EXPECTING_PASSWORD:
-            response = self._client_socket.recv(1024)
+            response = self._receive()
 
         # Relay whatever the server sent back to the user after verification,
         # and update any internal client state upon success
@@ -532,16 +776,13 @@ class BlueTraceClient():
         ''' Logs out this client. '''
 
         self._client_socket.send(bluetrace_protocol.LOGOUT_CLIENT)
-        self._username = None
         self._temp_id = None
 
     def _download_temp_id(self):
         ''' Downloads a temp ID from the server for this client. '''
 
         self._client_socket.send(bluetrace_protocol.DOWNLOAD_TEMP_ID)
-        temp_id = self._client_socket \
-                            .recv(bluetrace_protocol.TEMP_ID_SIZE) \
-                            .decode()
+        temp_id = self._receive(bluetrace_protocol.TEMP_ID_SIZE).decode()
         self._temp_id = {
             'temp_id': temp_id,
             'generated': generate_timestamp(datetime.now()),
@@ -558,20 +799,39 @@ class BlueTraceClient():
         # then wait until they're ready to start receiving
         self._client_socket.send(bluetrace_protocol.UPLOAD_CONTACT_LOG)
 
-        response = self._client_socket.recv(1024)
-        while response != bluetrace_protocol.READY_FOR_LOG_UPLOAD:
-            response = self._client_socket.recv(1024)
+        response = self._receive()
+        while not response.startswith(bluetrace_protocol.READY_FOR_LOG_UPLOAD):
+            response = self._receive()
+
+        # The server already has everything received before its watermark
+        _, _, watermark = response.decode().partition(' ')
+        watermark = convert_timestamp_to_epoch(watermark) if watermark else 0
 
-        # Send the contact log line-by-line
+        # Open encounters are sent as they currently stand, and the server
+        # will update them when they are sent again after more beacons
+        with self._open_encounters_lock:
+            open_encounters = [self._format_encounter(encounter)
+                               for encounter in self._open_encounters.values()]
+
+        # Send the rest of the contact log line-by-line
         with self._contact_log_lock:
             with open(f'{self._username}-contactlog.txt', 'r+') as contact_log:
-                for line in filter(None, contact_log):
-                    line = line.strip()
-                    temp_id, start_date, start_time, end_date, end_time = line.split()
-                    start = f'{start_date} {start_time}'
-                    end = f'{end_date} {end_time}'
-                    print(f'{temp_id}, {start}, {end}')
-                    self._client_socket.send(line.encode())
+                lines = [line.strip() for line in contact_log if line.strip()]
+
+            for line in lines + open_encounters:
+                # Skip any entries left in the contact log in an old format
+                try:
+                    temp_id, start, end, _, last_seen, _ = \
+                        parse_contact_log_entry(line)
+                except ValueError:
+                    print(f'Skipping invalid contact log entry: {line}')
+                    continue
+
+                if convert_timestamp_to_epoch(last_seen) < watermark:
+                    continue
+
+                print(f'{temp_id}, {start}, {end}')
+                self._client_socket.send(line.encode())
 
             # Inform the server that the client has finished sending the log
             self._client_socket.send(bluetrace_protocol.FINISHED_CONTACT_LOG)
@@ -605,6 +865,38 @@ class BlueTraceClient():
             # If the command is unknown, give a generic response
             print('Invalid command.')
 
+    def _run_session(self):
+        ''' Runs a session with the server this client is connected to. '''
+
+        # BlueTrace servers will initiate authentication upon connection (or
+        # say they're too busy to), so the client should reciprocate
+        response = self._receive()
+        while response != bluetrace_protocol.INITIATING_AUTH:
+            if response == bluetrace_protocol.SERVER_BUSY:
+                print(response.decode())
+                return
+
+            response = self._receive()
+
+        if self._authenticate():
+            # Create a contact log for the user.
+            with self._contact_log_lock:
+                if not path.exists(f'{self._username}-contactlog.txt'):
+                    open(f'{self._username}-contactlog.txt', 'w').close()
+
+            # Now that the client is authenticated, receive commands and
+            # start up a central beaconing thread for receiving beacons
+            self._central_socket \
+                = BlueTraceClientCentralThread(self, self._client_port)
+            self._central_socket.start()
+            command = input('> ').lower()
+            while command != 'logout':
+                self._process_command(command)
+                command = input('> ').lower()
+
+            # Initiate the logout phase
+            self._logout()
+
     def start(self):
         ''' Starts this BlueTrace client. '''
 
@@ -612,27 +904,10 @@ class BlueTraceClient():
             self._client_socket = client_socket
             client_socket.connect((self._server_ip, self._server_port))
 
-            # BlueTrace servers will initiate authentication upon connection,
-            # so the client should reciprocate
-            response = client_socket.recv(1024)
-            while response != bluetrace_protocol.INITIATING_AUTH:
-                response = client_socket.recv(1024)
-
-            if self._authenticate():
-                # Create a contact log for the user.
-                with self._contact_log_lock:
-                    if not path.exists(f'{self._username}-contactlog.txt'):
-                        open(f'{self._username}-contactlog.txt', 'w').close()
-
-                # Now that the client is authenticated, receive commands and
-                # start up a central beaconing thread for receiving beacons
-                self._central_socket \
-                    = BlueTraceClientCentralThread(self, self._client_port)
-                self._central_socket.start()
-                command = input('> ').lower()
-                while command != 'logout':
-                    self._process_command(command)
-                    command = input('> ').lower()
-
-                # Initiate the logout phase
-                self._logout()
+            try:
+                self._run_session()
+            except ConnectionError:
+                print('Lost connection to the server.')
+            finally:
+                # Keep any open encounters, however the session ended
+                self._flush_open_encounters()
@@ -21,6 +21,25 @@ ACCOUNT_IS_BLOCKED = 'Your account is blocked due to multiple login failures. '
 # The protocol message sent by the client when logging out
 LOGOUT_CLIENT = 'BT_AUTH_LOGOUT'.encode()
 
+# The informative message sent by the server, in place of initiating
+# authentication, when it is already serving as many clients as it can
+SERVER_BUSY = 'The server is busy. Please try again later.'.encode()
+
+# The default maximum number of clients a server will serve at once
+MAX_SESSIONS = 64
+
+# The default maximum number of connections waiting to be accepted by a server
+ACCEPT_BACKLOG = 16
+
+# The default time a server will wait for a logged in client's next request
+# before ending their session, in seconds
+SESSION_IDLE_TIMEOUT = 10 * 60
+
+# The default time a server will wait on a client to send or receive a message
+# partway through an exchange (e.g. authentication) before ending their
+# session, in seconds
+SESSION_IO_TIMEOUT = 30
+
 # The size of the temp ID, in bytes
 TEMP_ID_SIZE = 20
 
@@ -30,15 +49,25 @@ TEMP_ID_TTL = 15
 # The protocol message sent when a client is downloading a temp ID
 DOWNLOAD_TEMP_ID = 'BT_DOWN_TEMP_ID'.encode()
 
+# The size of the zero-padded count of beacons in a contact log entry, in bytes
+ENCOUNTER_COUNT_SIZE = 6
+
 # The size of each contact log entry, in bytes
 # [temp ID, 20] + [space, 1] + [start, 19] + [space, 1] + [expiry, 19]
-LOG_ENTRY_SIZE = 20 + 1 + 19 + 1 + 19
+#                             + [space, 1] + [first received, 19]
+#                             + [space, 1] + [last received, 19]
+#                             + [space, 1] + [beacon count, 6]
+LOG_ENTRY_SIZE = 20 + 1 + 19 + 1 + 19 + 1 + 19 + 1 + 19 + 1 \
+                 + ENCOUNTER_COUNT_SIZE
 
 # The protocol message sent when a client sends a contact log.
 UPLOAD_CONTACT_LOG = 'BT_UPLOAD_CONTACT_LOG'.encode()
 FINISHED_CONTACT_LOG = 'BT_FINISHED_CONTACT_LOG_UPLOAD'.encode()
 
-# The protocol message sent by the server after it is prepared to receive logs
+# The protocol message sent by the server after it is prepared to receive logs,
+# followed by a space and the client's upload watermark if it has one: the
+# timestamp at which the most recent entry the server has already seen was
+# last received
 READY_FOR_LOG_UPLOAD = 'BT_READY_FOR_CONTACT_LOG_UPLOAD'.encode()
 
 # The BlueTrace protocol version number
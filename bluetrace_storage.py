@@ -0,0 +1,444 @@
+# bluetrace_storage.py: Storage backends for the state kept by BlueTrace servers
+# by James Davidson for COMP3331, 20T2
+
+import sqlite3
+
+from abc import ABC, abstractmethod
+from threading import Lock
+from time import time
+from datetime import datetime
+from os import path
+
+import bluetrace_protocol
+
+''' Common helper functions '''
+
+
+def _convert_timestamp_to_epoch(timestamp):
+    ''' Converts a BlueTrace timestamp to seconds since the epoch. '''
+
+    return datetime.strptime(timestamp, bluetrace_protocol.TIMESTAMP_FORMAT) \
+                   .timestamp()
+
+
+''' Storage interface '''
+
+
+class BlueTraceStorage(ABC):
+    '''
+    An interface for the persistent state of a BlueTrace server.
+
+    Implementations must be safe to call from multiple server threads.
+    '''
+
+    @abstractmethod
+    def get_password(self, username):
+        '''
+        Retrieves a user's password, or None if the user does not exist.
+        '''
+
+    @abstractmethod
+    def add_temp_id(self, username, temp_id, start, end):
+        ''' Records a temp ID issued to a user, valid from start to end. '''
+
+    @abstractmethod
+    def get_username_from_temp_id(self, temp_id):
+        '''
+        Gets the username associated with the given temp ID, or None if the
+        temp ID is not known.
+        '''
+
+    @abstractmethod
+    def block(self, username, until):
+        ''' Blocks a user until the given epoch time. '''
+
+    @abstractmethod
+    def is_blocked(self, username, now):
+        '''
+        Determines if a user is blocked at the given epoch time, clearing
+        their block if it has expired.
+        '''
+
+    @abstractmethod
+    def get_upload_watermark(self, username):
+        '''
+        Gets the timestamp at which the most recently received entry stored
+        for a user was last received, or None if no entries are stored for
+        them.
+        '''
+
+    @abstractmethod
+    def add_contact_log(self, username, contact_log):
+        '''
+        Stores the entries of a contact log uploaded by a user, and returns the
+        entries which were new or updated.
+
+        Each entry is a (temp ID, start, end, first received, last received,
+        beacon count) tuple of strings. Entries are identified by their temp ID,
+        start and first received time, since an encounter which was still open
+        when it was uploaded is uploaded again once it has received more
+        beacons. Stored entries are only updated by entries with a higher beacon
+        count, and any others are skipped.
+        '''
+
+    def close(self):
+        ''' Releases any resources held by this storage backend. '''
+
+
+''' Storage backends '''
+
+
+class BlueTraceFileStorage(BlueTraceStorage):
+    '''
+    A storage backend using flat text files.
+
+    Blocked users are only kept in memory, and are forgotten on restart.
+    The stored entries and upload watermark of each user are rebuilt from the
+    contact logs file on startup, which reads the file's full history, so the
+    SQLite backend should be preferred for large deployments.
+
+    Only the entries that a client could still send again are remembered, i.e.
+    those whose temp ID is still valid or that were last received no earlier
+    than the user's upload watermark.
+    '''
+
+    def __init__(self, credentials_file='credentials.txt',
+                 temp_ids_file='tempIDs.txt',
+                 contact_logs_file='contactlogs.txt'):
+        self._credentials_file = credentials_file
+        self._temp_ids_file = temp_ids_file
+        self._contact_logs_file = contact_logs_file
+        self._blocked_users = {}
+        self._stored_entries = {}
+        self._upload_watermarks = {}
+        self._resource_locks = {
+            'blocked_users': Lock(),
+            'contact_logs': Lock(),
+            'credentials': Lock(),
+            'temp_ids': Lock()
+        }
+
+        # Create a file to store temporary IDs if there isn't one already
+        with self._resource_locks['temp_ids']:
+            if not path.exists(self._temp_ids_file):
+                open(self._temp_ids_file, 'w').close()
+
+        # Rebuild the stored entries from any previously uploaded logs
+        with self._resource_locks['contact_logs']:
+            if path.exists(self._contact_logs_file):
+                with open(self._contact_logs_file, 'r') as contact_logs:
+                    for line in filter(str.strip, contact_logs):
+                        # Skip any lines written in an old format
+                        try:
+                            username, temp_id, *timestamps, count = line.split()
+                            entry = (temp_id, *(' '.join(timestamps[i:i + 2])
+                                                for i in range(0, 8, 2)), count)
+                            self._store_entry(username, entry)
+                        except ValueError:
+                            continue
+
+                for username in self._stored_entries:
+                    self._forget_settled_entries(username)
+
+    ''' Helper storage methods '''
+
+    def _store_entry(self, username, entry):
+        '''
+        Records a contact log entry as stored for a user, advancing their
+        upload watermark past it, and returns whether or not the entry was new
+        or updated an already stored one.
+        '''
+
+        temp_id, start, end, first_seen, last_seen, count = entry
+        key = (temp_id, start, first_seen)
+        seen = _convert_timestamp_to_epoch(last_seen)
+        expiry = _convert_timestamp_to_epoch(end)
+        stored_entries = self._stored_entries.setdefault(username, {})
+        stored_count, *_ = stored_entries.get(key, (0,))
+        if stored_count >= int(count):
+            return False
+
+        stored_entries[key] = (int(count), seen, expiry)
+        if seen >= self._upload_watermarks.get(username, (seen, None))[0]:
+            self._upload_watermarks[username] = (seen, last_seen)
+
+        return True
+
+    def _forget_settled_entries(self, username):
+        '''
+        Forgets a user's stored entries which their client can no longer send
+        again, since their temp ID has expired and they were last received
+        before the user's upload watermark.
+        '''
+
+        watermark, _ = self._upload_watermarks.get(username, (None, None))
+        stored_entries = self._stored_entries.get(username, {})
+        now = time()
+
+        for key, (_, seen, expiry) in list(stored_entries.items()):
+            if expiry < now and seen < watermark:
+                del stored_entries[key]
+
+    ''' Main storage methods '''
+
+    def get_password(self, username):
+        ''' Retrieves a user's password from the credentials file. '''
+
+        client_password = None
+
+        with self._resource_locks['credentials']:
+            with open(self._credentials_file, 'r+') as credentials:
+                line = credentials.readline().strip()
+                while line and client_password is None:
+                    client_username, password = line.split()
+                    if client_username == username:
+                        client_password = password
+                    else:
+                        line = credentials.readline().strip()
+
+        return client_password
+
+    def add_temp_id(self, username, temp_id, start, end):
+        ''' Appends a temp ID to the temp IDs file. '''
+
+        with self._resource_locks['temp_ids']:
+            with open(self._temp_ids_file, 'a+') as temp_ids:
+                temp_ids.write(f'{username} {temp_id} {start} {end}\n')
+
+    def get_username_from_temp_id(self, temp_id):
+        ''' Searches the temp IDs file for the owner of a temp ID. '''
+
+        client_username = None
+
+        with self._resource_locks['temp_ids']:
+            with open(self._temp_ids_file, 'r+') as temp_ids:
+                line = temp_ids.readline()
+                while line and client_username is None:
+                    username, client_temp_id, *_ = line.split()
+                    if client_temp_id == temp_id:
+                        client_username = username
+                    else:
+                        line = temp_ids.readline()
+
+        return client_username
+
+    def block(self, username, until):
+        ''' Blocks a user until the given epoch time. '''
+
+        with self._resource_locks['blocked_users']:
+            self._blocked_users[username] = until
+
+    def is_blocked(self, username, now):
+        ''' Determines if a user is blocked at the given epoch time. '''
+
+        blocked = True
+
+        with self._resource_locks['blocked_users']:
+            block_time = self._blocked_users.get(username, None)
+            if block_time is None or block_time <= now:
+                self._blocked_users.pop(username, None)
+                blocked = False
+
+        return blocked
+
+    def get_upload_watermark(self, username):
+        ''' Gets a user's upload watermark. '''
+
+        with self._resource_locks['contact_logs']:
+            _, watermark = self._upload_watermarks.get(username, (None, None))
+
+        return watermark
+
+    def add_contact_log(self, username, contact_log):
+        '''
+        Appends the entries of a contact log which are new or updated to the
+        contact logs file, where the last line for an entry is the latest.
+        '''
+
+        with self._resource_locks['contact_logs']:
+            self._forget_settled_entries(username)
+            new_entries = [entry for entry in contact_log
+                           if self._store_entry(username, entry)]
+
+            with open(self._contact_logs_file, 'a+') as contact_logs:
+                contact_logs.writelines(f'{username} {" ".join(entry)}\n'
+                                        for entry in new_entries)
+
+        return new_entries
+
+
+class BlueTraceSQLiteStorage(BlueTraceStorage):
+    '''
+    A storage backend using an SQLite database in write-ahead logging mode.
+
+    Credentials are imported from the credentials file whenever the database
+    is opened, replacing any accounts already in the database, so that the
+    file remains the source of truth for accounts. Changes to the file only
+    take effect when the server is restarted.
+    '''
+
+    _SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS credentials (
+            username TEXT PRIMARY KEY,
+            password TEXT NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS temp_ids (
+            temp_id TEXT NOT NULL,
+            username TEXT NOT NULL,
+            issued REAL NOT NULL,
+            start_time TEXT NOT NULL,
+            end_time TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS temp_ids_by_temp_id ON temp_ids (temp_id);
+        CREATE INDEX IF NOT EXISTS temp_ids_by_issued ON temp_ids (issued);
+
+        CREATE TABLE IF NOT EXISTS blocked_users (
+            username TEXT PRIMARY KEY,
+            until INTEGER NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS contact_logs (
+            username TEXT NOT NULL,
+            temp_id TEXT NOT NULL,
+            start_time TEXT NOT NULL,
+            end_time TEXT NOT NULL,
+            first_seen_time TEXT NOT NULL,
+            last_seen REAL NOT NULL,
+            last_seen_time TEXT NOT NULL,
+            count INTEGER NOT NULL
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS contact_logs_by_encounter
+            ON contact_logs (username, temp_id, start_time, first_seen_time);
+        CREATE INDEX IF NOT EXISTS contact_logs_by_upload_watermark
+            ON contact_logs (username, last_seen);
+    '''
+
+    def __init__(self, database, credentials_file='credentials.txt'):
+        self._lock = Lock()
+        self._connection = sqlite3.connect(database, check_same_thread=False)
+
+        with self._lock:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.executescript(self._SCHEMA)
+
+        if path.exists(credentials_file):
+            self._import_credentials(credentials_file)
+
+    ''' Helper storage methods '''
+
+    def _import_credentials(self, credentials_file):
+        '''
+        Replaces all accounts in the database with those in a credentials file
+        in one transaction.
+        '''
+
+        with open(credentials_file, 'r') as credentials:
+            accounts = [line.split() for line in credentials if line.strip()]
+
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM credentials')
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO credentials VALUES (?, ?)', accounts)
+
+    ''' Main storage methods '''
+
+    def get_password(self, username):
+        ''' Retrieves a user's password from the credentials table. '''
+
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT password FROM credentials WHERE username = ?',
+                (username,)).fetchone()
+
+        return row[0] if row else None
+
+    def add_temp_id(self, username, temp_id, start, end):
+        ''' Inserts a temp ID, indexed by its value and its issue time. '''
+
+        issued = _convert_timestamp_to_epoch(start)
+
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT INTO temp_ids VALUES (?, ?, ?, ?, ?)',
+                (temp_id, username, issued, start, end))
+
+    def get_username_from_temp_id(self, temp_id):
+        ''' Looks up the owner of the most recently issued matching temp ID. '''
+
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT username FROM temp_ids WHERE temp_id = ? '
+                'ORDER BY issued DESC LIMIT 1', (temp_id,)).fetchone()
+
+        return row[0] if row else None
+
+    def block(self, username, until):
+        ''' Blocks a user until the given epoch time. '''
+
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO blocked_users VALUES (?, ?)',
+                (username, until))
+
+    def is_blocked(self, username, now):
+        ''' Determines if a user is blocked at the given epoch time. '''
+
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                'SELECT until FROM blocked_users WHERE username = ?',
+                (username,)).fetchone()
+            if row is None:
+                return False
+
+            if row[0] <= now:
+                self._connection.execute(
+                    'DELETE FROM blocked_users WHERE username = ?',
+                    (username,))
+                return False
+
+        return True
+
+    def get_upload_watermark(self, username):
+        ''' Looks up a user's upload watermark using the contact logs index. '''
+
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT last_seen_time FROM contact_logs WHERE username = ? '
+                'ORDER BY last_seen DESC LIMIT 1', (username,)).fetchone()
+
+        return row[0] if row else None
+
+    def add_contact_log(self, username, contact_log):
+        '''
+        Upserts all entries of a contact log in one transaction, relying on the
+        uniqueness of encounters to update those that are already stored.
+        '''
+
+        new_entries = []
+
+        with self._lock, self._connection:
+            for entry in contact_log:
+                temp_id, start, end, first_seen, last_seen, count = entry
+                cursor = self._connection.execute(
+                    'INSERT INTO contact_logs VALUES (?, ?, ?, ?, ?, ?, ?, ?) '
+                    'ON CONFLICT (username, temp_id, start_time, '
+                    'first_seen_time) DO UPDATE SET '
+                    'last_seen = excluded.last_seen, '
+                    'last_seen_time = excluded.last_seen_time, '
+                    'count = excluded.count '
+                    'WHERE excluded.count > contact_logs.count',
+                    (username, temp_id, start, end, first_seen,
+                     _convert_timestamp_to_epoch(last_seen), last_seen,
+                     int(count)))
+                if cursor.rowcount:
+                    new_entries.append(entry)
+
+        return new_entries
+
+    def close(self):
+        ''' Closes the connection to the database. '''
+
+        with self._lock:
+            self._connection.close()
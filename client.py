@@ -1,5 +1,5 @@
 # client.py: Client program for the BlueTrace protocol simulator
-# Usage: python3 client.py [server IP] [server port] [client UDP port]
+# Usage: python3 client.py [server IP] [server port] [client UDP port] [encounter gap]
 
 import sys
 
@@ -7,7 +7,8 @@ from bluetrace import BlueTraceClient
 
 if __name__ == '__main__':
     if len(sys.argv) < 4:
-        print('Usage: python3 client.py [server IP] [server port] [client UDP port]')
+        print('Usage: python3 client.py [server IP] [server port] '
+              '[client UDP port] [encounter gap]')
         sys.exit(1)
 
     try:
@@ -18,5 +19,12 @@ if __name__ == '__main__':
         print('Invalid server or client port')
         sys.exit(1)
 
-    client = BlueTraceClient(server_ip, server_port, client_port)
+    # Aggregate repeated beacons into encounters if an encounter gap is given
+    try:
+        encounter_gap = int(sys.argv[4]) if len(sys.argv) > 4 else None
+    except ValueError:
+        print('Invalid encounter gap')
+        sys.exit(1)
+
+    client = BlueTraceClient(server_ip, server_port, client_port, encounter_gap)
     client.start()
@@ -1,20 +1,47 @@
 # server.py: Server program for the BlueTrace protocol simulator
-# Usage: python3 server.py [server port] [block duration]
+# Usage: python3 server.py [server port] [block duration] [database file]
+#                          [--max-sessions N] [--idle-timeout SECONDS]
+#                          [--io-timeout SECONDS]
 
-import sys
+from argparse import ArgumentParser
+
+import bluetrace_protocol
 from bluetrace import BlueTraceServer
+from bluetrace_storage import BlueTraceSQLiteStorage
 
 if __name__ == '__main__':
-    if len(sys.argv) < 3:
-        print('Usage: python3 server.py [server port] [block duration]')
-        sys.exit(1)
+    parser = ArgumentParser(description='Server program for the BlueTrace '
+                                        'protocol simulator')
+    parser.add_argument('port', type=int, help='server port')
+    parser.add_argument('block_duration', type=int,
+                        help='seconds to block clients for upon repeated '
+                             'authentication failure')
+    parser.add_argument('database', nargs='?',
+                        help='SQLite database file to keep server state in '
+                             '(flat text files are used if not given)')
+    parser.add_argument('--max-sessions', type=int,
+                        default=bluetrace_protocol.MAX_SESSIONS,
+                        help='maximum number of clients served at once '
+                             '(default: %(default)s)')
+    parser.add_argument('--idle-timeout', type=int,
+                        default=bluetrace_protocol.SESSION_IDLE_TIMEOUT,
+                        help='seconds to wait for a client\'s next request or '
+                             'login details (default: %(default)s)')
+    parser.add_argument('--io-timeout', type=int,
+                        default=bluetrace_protocol.SESSION_IO_TIMEOUT,
+                        help='seconds to wait on a client partway through an '
+                             'exchange (default: %(default)s)')
+    args = parser.parse_args()
+
+    if min(args.max_sessions, args.idle_timeout, args.io_timeout) < 1:
+        parser.error('the maximum sessions and timeouts must be positive')
 
-    try:
-        port = int(sys.argv[1])
-        block_duration = int(sys.argv[2])
-    except ValueError:
-        print('Invalid server port or block duration')
-        sys.exit(1)
+    # Keep server state in an SQLite database if one is given, and in flat
+    # text files otherwise
+    storage = BlueTraceSQLiteStorage(args.database) if args.database else None
 
-    server = BlueTraceServer(port, block_duration)
+    server = BlueTraceServer(args.port, args.block_duration, storage,
+                             max_sessions=args.max_sessions,
+                             idle_timeout=args.idle_timeout,
+                             io_timeout=args.io_timeout)
     server.start()